@@ -3,14 +3,27 @@ AI Analysis Engine — Vision-based
 Sends PDF page images directly to a vision-capable AI model via OpenRouter.
 The AI reads the actual paper (math, diagrams, everything) and returns structured classification.
 """
-import os
-import json
+import hashlib
 import logging
 import time
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+
+import openrouter_client
 
 logger = logging.getLogger(__name__)
 
+MAX_PARALLEL_CHUNKS = 4  # Cap in-flight requests to stay under OpenRouter per-key rate limits
+
+# Chunk sizing — papers up to PAGES_PER_CHUNK go in one request. Longer papers send a
+# PROBE_PAGES chunk first and size the rest from its latency (vision latency grows
+# faster than linearly with image count, so smaller parallel chunks can finish sooner)
+PAGES_PER_CHUNK = 8
+PROBE_PAGES = 4
+TARGET_CHUNK_SECONDS = 60
+MIN_ADAPTIVE_PAGES = 2
+MAX_ADAPTIVE_PAGES = 10
+
 SYSTEM_PROMPT = """You are an expert exam paper analyzer for Indian competitive exams (JEE Main, JEE Advanced, NEET-UG).
 
 TASK: You are given images of an exam paper. Look at each page carefully. Identify and classify every question you can see.
@@ -63,148 +76,78 @@ RESPOND IN JSON FORMAT ONLY — no markdown, no explanation:
   ]
 }"""
 
+REQUIRED_FIELDS = frozenset({"sno", "question_text", "subject", "topic", "subtopic_name", "difficulty"})
+VALID_DIFFICULTIES = frozenset({"Easy", "Moderate", "Difficult"})
+
+# Shared across every chunk and request — never mutated.
+# No cache_control breakpoint: the system prompt (~600 tokens) is the only prefix chunks
+# share, and it is below Anthropic's and Gemini's minimum cacheable prompt length
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+INSTRUCTION_PREFIX = (
+    "Analyze this exam paper. Look at every page image above. Identify and classify each question."
+    "\n\nIMPORTANT: Use the EXACT question numbers as printed in the PDF. Do NOT renumber."
+)
+
+# Changes whenever the prompts do, so cached analyses from older prompts are not reused
+PROMPT_VERSION = hashlib.blake2b((SYSTEM_PROMPT + INSTRUCTION_PREFIX).encode("utf-8"), digest_size=8).hexdigest()
+
 
 def build_vision_messages(page_images: list, exam_type: str = None, subjects: list = None) -> list:
     """
     Build multimodal message payload with page images for vision AI.
-    Each page image is sent as a base64 image_url.
+    page_images are base64 data URLs (see pdf_extractor) sent as-is in image_url parts.
     subjects is now a list like ["Physics", "Chemistry", "Mathematics"]
     """
-    # Build the user message content: images first, then text instruction
-    content = []
-
-    # Add each page as an image
-    for i, b64 in enumerate(page_images):
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/png;base64,{b64}"
-            }
-        })
+    # Build the user message content: images first, then text instruction.
+    # OpenRouter has no upload endpoint to reference images by ID, so pages travel
+    # inline — they are base64-encoded once in pdf_extractor and reused on retries.
+    content = [
+        {"type": "image_url", "image_url": {"url": data_url}}
+        for data_url in page_images
+    ]
 
     # Build instruction with exam and subject context
-    instruction = "Analyze this exam paper. Look at every page image above. Identify and classify each question."
-    instruction += "\n\nIMPORTANT: Use the EXACT question numbers as printed in the PDF. Do NOT renumber."
+    instruction = [INSTRUCTION_PREFIX]
 
     if exam_type:
-        instruction += f"\n\nThis is a {exam_type} exam paper."
+        instruction.append(f"\n\nThis is a {exam_type} exam paper.")
 
     if subjects:
         subjects_str = ", ".join(subjects)
-        instruction += f"\nSubjects in this paper: {subjects_str}"
-        instruction += f"\nClassify each question's subject as ONLY one of: {subjects_str}"
+        instruction.append(f"\nSubjects in this paper: {subjects_str}")
+        instruction.append(f"\nClassify each question's subject as ONLY one of: {subjects_str}")
 
         # Map Botany/Zoology to Biology for NEET reference matching
         if "Botany" in subjects or "Zoology" in subjects:
-            instruction += "\nNote: For Botany questions, set subject to 'Botany'. For Zoology questions, set subject to 'Zoology'."
+            instruction.append("\nNote: For Botany questions, set subject to 'Botany'. For Zoology questions, set subject to 'Zoology'.")
 
-    content.append({"type": "text", "text": instruction})
+    content.append({"type": "text", "text": "".join(instruction)})
 
     return [
-        {"role": "system", "content": SYSTEM_PROMPT},
+        _SYSTEM_MSG,
         {"role": "user", "content": content},
     ]
 
 
-def call_openrouter(model_id: str, messages: list, retry: int = 0) -> dict:
-    """Call OpenRouter API with the selected model (vision-capable)."""
-    api_key = os.environ.get("OPENROUTER_API_KEY", "")
-    if not api_key:
-        raise ValueError("OPENROUTER_API_KEY not set in environment")
-
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://exam-analyzer.local",
-    }
-
-    payload = {
-        "model": model_id,
-        "messages": messages,
-        "temperature": 0.1,
-        "max_tokens": 16000,  # Higher limit for vision responses with full question text
-    }
-
-    try:
-        logger.info(f"Calling OpenRouter with model: {model_id} (attempt {retry + 1})")
-        start = time.time()
-
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=180,  # Vision models can take longer
-        )
-        elapsed = time.time() - start
-        logger.info(f"OpenRouter responded in {elapsed:.1f}s — status {response.status_code}")
-
-        if response.status_code != 200:
-            error = response.text
-            logger.error(f"OpenRouter error: {error}")
-            if retry < 2:
-                time.sleep(3)
-                return call_openrouter(model_id, messages, retry + 1)
-            raise RuntimeError(f"OpenRouter API error: {response.status_code} — {error}")
-
-        data = response.json()
-        content = data["choices"][0]["message"]["content"]
-
-        return {"content": content, "elapsed": elapsed, "model": model_id}
-
-    except requests.exceptions.Timeout:
-        logger.warning(f"Timeout calling {model_id}")
-        if retry < 2:
-            return call_openrouter(model_id, messages, retry + 1)
-        raise
-
-
 def parse_ai_response(raw_content: str) -> dict:
-    """Parse the AI's JSON response, handling common formatting issues."""
-    content = raw_content.strip()
-
-    # Strip markdown code fences if present
-    if content.startswith("```"):
-        content = content.split("\n", 1)[-1]
-    if content.endswith("```"):
-        content = content.rsplit("```", 1)[0]
-    content = content.strip()
-    if content.startswith("json"):
-        content = content[4:].strip()
-
-    try:
-        parsed = json.loads(content)
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON parse error: {e}")
-        logger.error(f"Raw content (first 500 chars): {content[:500]}")
-        # Try to extract JSON object from the response
-        start = content.find("{")
-        end = content.rfind("}") + 1
-        if start >= 0 and end > start:
-            try:
-                parsed = json.loads(content[start:end])
-            except json.JSONDecodeError:
-                raise ValueError(f"Could not parse AI response as JSON: {e}")
-        else:
-            raise ValueError(f"No JSON object found in AI response: {e}")
+    """Parse the AI's JSON response and normalise each question's fields."""
+    parsed = openrouter_client.parse_json_response(raw_content)
 
     # Validate structure
     if "questions" not in parsed:
         raise ValueError("AI response missing 'questions' key")
 
     for q in parsed["questions"]:
-        required = ["sno", "question_text", "subject", "topic", "subtopic_name", "difficulty"]
-        missing = [k for k in required if k not in q]
+        missing = REQUIRED_FIELDS.difference(q)
         if missing:
-            logger.warning(f"Question {q.get('sno', '?')} missing fields: {missing}")
+            logger.warning(f"Question {q.get('sno', '?')} missing fields: {sorted(missing)}")
             for k in missing:
                 q[k] = "Unknown" if k != "sno" else 0
 
         # Normalize difficulty
-        diff = q.get("difficulty", "").strip().capitalize()
-        if diff not in ("Easy", "Moderate", "Difficult"):
-            q["difficulty"] = "Moderate"
-        else:
-            q["difficulty"] = diff
+        diff = q["difficulty"].strip().capitalize()
+        q["difficulty"] = diff if diff in VALID_DIFFICULTIES else "Moderate"
 
         # Add question_label using the exact sno from the PDF
         q["question_label"] = f"Q.{q.get('sno', 0)}"
@@ -212,7 +155,7 @@ def parse_ai_response(raw_content: str) -> dict:
     return parsed
 
 
-def chunk_pages(page_images: list, max_pages_per_chunk: int = 8) -> list:
+def chunk_pages(page_images: list, max_pages_per_chunk: int = PAGES_PER_CHUNK) -> list:
     """
     Split page images into chunks for very large papers.
     Most vision models handle 8-10 images well per request.
@@ -223,31 +166,85 @@ def chunk_pages(page_images: list, max_pages_per_chunk: int = 8) -> list:
     return chunks
 
 
+def pages_per_chunk_for(seconds_per_page: float) -> int:
+    """Pick a chunk size so each request should finish in about TARGET_CHUNK_SECONDS."""
+    if seconds_per_page <= 0:
+        return MAX_ADAPTIVE_PAGES
+    return max(MIN_ADAPTIVE_PAGES, min(MAX_ADAPTIVE_PAGES, int(TARGET_CHUNK_SECONDS / seconds_per_page)))
+
+
+def analyze_chunk(chunk: list, model_id: str, exam_type: str = None, subjects: list = None) -> tuple:
+    """Send one chunk of pages to the AI model. Returns (questions, elapsed seconds)."""
+    messages = build_vision_messages(chunk, exam_type, subjects)
+    response = openrouter_client.call_openrouter(model_id, messages, max_tokens=16000)  # Full question text needs room
+    parsed = parse_ai_response(response["content"])
+    return parsed["questions"], response["elapsed"]
+
+
+def analyze_chunks(page_images, model_id: str, exam_type: str = None, subjects: list = None,
+                   page_count: int = None):
+    """
+    Send page images to the AI model in chunks and yield results as they land.
+    Yields (chunk_index, questions) in completion order, so callers can start
+    downstream work on one chunk while the others are still in flight.
+
+    page_images may be a list, or a lazy iterator together with its page_count
+    (see pdf_extractor.iter_pdf_pages).
+    Papers longer than one chunk are profiled first: a PROBE_PAGES chunk is timed
+    and the remaining pages are re-chunked from the measured per-page latency.
+    The probe is sent as soon as its pages exist, while the rest are still rendering.
+    """
+    if page_count is None:
+        page_count = len(page_images)
+    pages = iter(page_images)
+
+    first_index = 0
+    if page_count <= PAGES_PER_CHUNK:
+        chunks = chunk_pages(list(pages))
+    else:
+        probe = list(islice(pages, PROBE_PAGES))
+        logger.info(f"Profiling with chunk 1 ({len(probe)} pages)")
+        with ThreadPoolExecutor(max_workers=1) as probe_ex:
+            probe_future = probe_ex.submit(analyze_chunk, probe, model_id, exam_type, subjects)
+            remaining = list(pages)
+            questions, elapsed = probe_future.result()
+        yield 0, questions
+
+        size = pages_per_chunk_for(elapsed / len(probe))
+        chunks = chunk_pages(remaining, size)
+        first_index = 1
+        logger.info(f"Chunk 1 took {elapsed:.1f}s — sending remaining pages {size} per chunk")
+
+    # Each chunk is an independent network-bound call — keep several in flight
+    with ThreadPoolExecutor(max_workers=min(len(chunks), MAX_PARALLEL_CHUNKS) or 1) as ex:
+        futures = {}
+        for i, chunk in enumerate(chunks, start=first_index):
+            logger.info(f"Submitting chunk {i+1} ({len(chunk)} pages)")
+            futures[ex.submit(analyze_chunk, chunk, model_id, exam_type, subjects)] = i
+
+        for future in as_completed(futures):
+            questions, _ = future.result()
+            yield futures[future], questions
+
+
 def analyze(page_images: list, model_id: str, exam_type: str = None, subjects: list = None) -> dict:
     """
     Main entry point: analyze PDF page images with a vision-capable AI model.
-    Handles chunking for large papers (>8 pages).
+    Handles chunking for large papers (>8 pages); chunks are sent in parallel.
     Returns combined classification results.
 
     subjects: list of subjects like ["Physics", "Chemistry", "Mathematics"]
     """
-    chunks = chunk_pages(page_images)
-    logger.info(f"Processing {len(page_images)} pages in {len(chunks)} chunk(s)")
-
-    all_results = []
-    total_time = 0
-
-    for i, chunk in enumerate(chunks):
-        logger.info(f"Processing chunk {i+1}/{len(chunks)} ({len(chunk)} pages)")
-        messages = build_vision_messages(chunk, exam_type, subjects)
-
-        response = call_openrouter(model_id, messages)
-        total_time += response["elapsed"]
+    logger.info(f"Processing {len(page_images)} pages")
 
-        parsed = parse_ai_response(response["content"])
-        all_results.extend(parsed["questions"])
+    start = time.time()
+    results = {}
+    for i, questions in analyze_chunks(page_images, model_id, exam_type, subjects):
+        results[i] = questions
+    total_time = time.time() - start
 
     # Sort by sno to maintain PDF order (do NOT renumber)
+    all_results = [q for i in sorted(results) for q in results[i]]
     all_results.sort(key=lambda q: q.get("sno", 0))
 
     return {
@@ -255,5 +252,5 @@ def analyze(page_images: list, model_id: str, exam_type: str = None, subjects: l
         "questions": all_results,
         "model_used": model_id,
         "processing_time": total_time,
-        "chunks_processed": len(chunks),
+        "chunks_processed": len(results),
     }
@@ -7,13 +7,20 @@ import os
 import time
 import uuid
 import json
+import shutil
+import hashlib
 import logging
+import mimetypes
 import tempfile
 import traceback
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import quote
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
+from werkzeug.http import dump_options_header
 
 import pdf_extractor
 import ai_analyzer
@@ -24,12 +31,44 @@ import xlsx_generator
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
 logger = logging.getLogger("exam-analyzer")
 
+# Parse reference data once at startup rather than on the first request per subject
+subtopic_matcher.preload()
+
 app = Flask(__name__)
+app.json.ensure_ascii = False  # Send question text (α, ∫, H₂O …) as UTF-8, not \uXXXX escapes
 CORS(app)  # Allow WordPress to call from different domain
 
 TEMP_DIR = tempfile.mkdtemp(prefix="exam_")
-OUTPUT_DIR = os.path.join(TEMP_DIR, "outputs")
+# Generated DOCX/XLSX files. Defaults to a fresh directory per start; set OUTPUT_DIR to a
+# fixed path when nginx serves downloads (DOWNLOAD_ACCEL_PREFIX), since its alias must match
+OUTPUT_DIR = os.environ.get("OUTPUT_DIR") or os.path.join(TEMP_DIR, "outputs")
+JOBS_DIR = os.path.join(TEMP_DIR, "jobs")
+CACHE_DIR = os.path.join(TEMP_DIR, "cache")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(JOBS_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# Re-uploads of an identical PDF with the same options reuse the earlier result (0 disables)
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 24 * 3600))
+
+# Set to an nginx `internal` location to serve files via X-Accel-Redirect. With
+# DOWNLOAD_ACCEL_PREFIX=/internal-downloads/ and OUTPUT_DIR=/srv/exam-analyzer/outputs:
+#
+#     location /internal-downloads/ {
+#         internal;
+#         alias /srv/exam-analyzer/outputs/;
+#     }
+DOWNLOAD_ACCEL_PREFIX = os.environ.get("DOWNLOAD_ACCEL_PREFIX", "")
+if DOWNLOAD_ACCEL_PREFIX and not os.environ.get("OUTPUT_DIR"):
+    logger.warning("DOWNLOAD_ACCEL_PREFIX ignored: nginx cannot alias the per-start temp OUTPUT_DIR — set OUTPUT_DIR")
+    DOWNLOAD_ACCEL_PREFIX = ""
+
+# Output filenames embed the job id, so a given download never changes — let clients keep it
+DOWNLOAD_MAX_AGE = 3600
+
+# Background pool for /analyze requests submitted with async=1
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
 
 
 @app.route("/health", methods=["GET"])
@@ -43,6 +82,187 @@ def health():
     })
 
 
+def write_json_atomic(path: str, data: dict):
+    # Unique temp name per writer — identical uploads finishing together target the same path
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def result_cache_key(pdf_path: str, paper_name: str, model_id: str, exam_type: str, subjects_str: str) -> str:
+    """Hash of the PDF bytes plus every input that shapes the result (incl. prompt version)."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    h.update(f"|{paper_name}|{model_id}|{exam_type}|{subjects_str}|{ai_analyzer.PROMPT_VERSION}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def load_cached_result(cache_key: str):
+    """Return a cached completed result, or None if missing, expired or its files are gone."""
+    path = os.path.join(CACHE_DIR, f"{cache_key}.json")
+    if not RESULT_CACHE_TTL or not os.path.exists(path):
+        return None
+
+    # A cache that can't be read is just a miss — it must never fail the upload
+    try:
+        if time.time() - os.path.getmtime(path) > RESULT_CACHE_TTL:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        for key in ("docx_filename", "xlsx_filename"):
+            if not os.path.exists(os.path.join(OUTPUT_DIR, cached[key])):
+                return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable cached result {cache_key}: {e}")
+        return None
+    return cached
+
+
+def run_pipeline(job_id: str, pdf_path: str, paper_name: str, model_id: str,
+                 exam_type: str, subjects: list, subjects_str: str, upload_id: str,
+                 start_time: float) -> dict:
+    """
+    Run Steps 1-4 for a saved PDF.
+    Returns the completed response payload; raises on any failure.
+    """
+    docx_filename = f"{paper_name}_Analysis_{job_id}.docx"
+    xlsx_filename = f"{paper_name}_Analysis_{job_id}.xlsx"
+    docx_path = os.path.join(OUTPUT_DIR, docx_filename)
+    xlsx_path = os.path.join(OUTPUT_DIR, xlsx_filename)
+
+    cache_key = result_cache_key(pdf_path, paper_name, model_id, exam_type, subjects_str)
+    cached = load_cached_result(cache_key)
+    if cached:
+        # Same PDF and options as an earlier job — copy its outputs under this job's names
+        shutil.copyfile(os.path.join(OUTPUT_DIR, cached["docx_filename"]), docx_path)
+        shutil.copyfile(os.path.join(OUTPUT_DIR, cached["xlsx_filename"]), xlsx_path)
+        elapsed = time.time() - start_time
+        logger.info(f"[{job_id}] Cache hit (job {cached['job_id']}) — done in {elapsed:.1f}s")
+        return dict(
+            cached,
+            job_id=job_id,
+            upload_id=upload_id,
+            processing_time=round(elapsed, 1),
+            docx_filename=docx_filename,
+            xlsx_filename=xlsx_filename,
+            docx_url=f"/download/{docx_filename}",
+            xlsx_url=f"/download/{xlsx_filename}",
+        )
+
+    # Step 1: Convert PDF pages to images. Pages stream straight into Step 2, so the
+    # first chunk goes out while later pages are still rendering
+    logger.info(f"[{job_id}] Step 1: Converting PDF to images")
+    extraction = pdf_extractor.process_pdf(pdf_path)
+    page_count = extraction["page_count"]
+    page_images = extraction["page_images"]
+    if not page_count:
+        raise ValueError("No pages found in PDF")
+
+    # The form's exam_type is authoritative; the detected one is only a sanity check
+    if extraction["exam_type"] not in ("UNKNOWN", exam_type.upper()):
+        logger.warning(f"[{job_id}] Paper looks like {extraction['exam_type']}, but exam_type={exam_type} was requested")
+
+    logger.info(f"[{job_id}] Streaming {page_count} page images, exam={exam_type}, subjects={subjects}")
+
+    # Step 2 + 3: AI Vision Analysis, with subtopic matching pipelined per chunk.
+    # Each chunk's questions are matched on a worker thread while the
+    # remaining chunks are still waiting on the AI model.
+    logger.info(f"[{job_id}] Step 2: AI Vision Analysis with {model_id}")
+    logger.info(f"[{job_id}] Step 3: Subtopic matching per chunk (exam_type={exam_type})")
+
+    matched = {}
+    with ThreadPoolExecutor(max_workers=1) as matcher:
+        for idx, chunk_questions in ai_analyzer.analyze_chunks(page_images, model_id, exam_type, subjects, page_count):
+            logger.info(f"[{job_id}] Chunk {idx + 1} returned {len(chunk_questions)} questions")
+            matched[idx] = matcher.submit(subtopic_matcher.match_all, chunk_questions, exam_type)
+
+        # Flatten in chunk order, then sort by sno to keep PDF order (do NOT renumber)
+        ai_questions = [q for idx in sorted(matched) for q in matched[idx].result()]
+    ai_questions.sort(key=lambda q: q.get("sno", 0))
+
+    if not ai_questions:
+        raise ValueError("AI did not detect any questions in the paper")
+
+    logger.info(f"[{job_id}] AI detected {len(ai_questions)} questions")
+
+    # Step 4: Generate outputs
+    logger.info(f"[{job_id}] Step 4: Generating DOCX/XLSX")
+    metadata = {
+        "paper_name": paper_name,
+        "exam_type": exam_type,
+        "subjects": subjects_str,
+        "model_used": model_id,
+    }
+
+    # Independent outputs written to different paths — build them side by side
+    with ThreadPoolExecutor(max_workers=2) as writers:
+        docx_future = writers.submit(docx_generator.generate, ai_questions, metadata, docx_path)
+        xlsx_future = writers.submit(xlsx_generator.generate, ai_questions, metadata, xlsx_path)
+        docx_future.result()
+        xlsx_future.result()
+
+    elapsed = time.time() - start_time
+    logger.info(f"[{job_id}] Done in {elapsed:.1f}s — {len(ai_questions)} questions")
+
+    result = {
+        "status": "completed",
+        "job_id": job_id,
+        "upload_id": upload_id,
+        "questions_count": len(ai_questions),
+        "pages_total": extraction["pages_total"],
+        "pages_analyzed": page_count,
+        "exam_type": exam_type,
+        "subjects": subjects_str,
+        "model_used": model_id,
+        "processing_time": round(elapsed, 1),
+        "docx_filename": docx_filename,
+        "xlsx_filename": xlsx_filename,
+        "docx_url": f"/download/{docx_filename}",
+        "xlsx_url": f"/download/{xlsx_filename}",
+        "questions": ai_questions,  # Full results for WP to store
+    }
+    if RESULT_CACHE_TTL:
+        # Best-effort: the job itself is done, so a failed cache write only costs a future re-run
+        try:
+            write_json_atomic(os.path.join(CACHE_DIR, f"{cache_key}.json"), result)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"[{job_id}] Could not cache result: {e}")
+    return result
+
+
+def failure_result(job_id: str, error: Exception, start_time: float) -> dict:
+    elapsed = time.time() - start_time
+    logger.error(f"[{job_id}] Failed: {error}\n{traceback.format_exc()}")
+    return {
+        "status": "failed",
+        "job_id": job_id,
+        "error": str(error),
+        "processing_time": round(elapsed, 1),
+    }
+
+
+def save_job_status(job_id: str, status: dict):
+    """Persist job status on disk so whichever worker serves /status can read it."""
+    write_json_atomic(os.path.join(JOBS_DIR, f"{job_id}.json"), status)
+
+
+def run_job(job_id: str, upload_id: str, start_time: float, **pipeline_args):
+    """Background worker body for queued /analyze requests."""
+    save_job_status(job_id, {"status": "processing", "job_id": job_id, "upload_id": upload_id})
+    try:
+        result = run_pipeline(job_id=job_id, upload_id=upload_id, start_time=start_time, **pipeline_args)
+    except Exception as e:
+        result = failure_result(job_id, e, start_time)
+    save_job_status(job_id, result)
+
+
 @app.route("/analyze", methods=["POST"])
 def analyze():
     """
@@ -51,6 +271,8 @@ def analyze():
     - model_id: OpenRouter model ID (must be vision-capable)
     - exam_type: JEE or NEET (mandatory from frontend)
     - subjects: comma-separated list e.g. "Physics,Chemistry,Mathematics"
+    - async: (optional) "1" to queue the job and return 202 immediately;
+      poll /status/<job_id> for the result
     Returns JSON with analysis results + download URLs for DOCX/XLSX.
     """
     pdf_file = request.files.get("pdf_file")
@@ -58,6 +280,7 @@ def analyze():
     exam_type = request.form.get("exam_type", "")
     subjects_str = request.form.get("subjects", "")
     upload_id = request.form.get("upload_id", "")
+    run_async = request.form.get("async", "").lower() in ("1", "true", "yes")
 
     if not pdf_file:
         return jsonify({"status": "failed", "error": "No PDF file uploaded"}), 400
@@ -83,76 +306,56 @@ def analyze():
     pdf_path = os.path.join(job_dir, pdf_file.filename)
     pdf_file.save(pdf_path)
 
-    try:
-        # Step 1: Convert PDF pages to images
-        logger.info(f"[{job_id}] Step 1: Converting PDF to images")
-        extraction = pdf_extractor.process_pdf(pdf_path, job_dir)
-        page_images = extraction["page_images"]
-
-        if not page_images:
-            raise ValueError("No pages found in PDF")
-
-        logger.info(f"[{job_id}] Got {len(page_images)} page images, exam={exam_type}, subjects={subjects}")
-
-        # Step 2: AI Vision Analysis — send page images to AI with exam/subject context
-        logger.info(f"[{job_id}] Step 2: AI Vision Analysis with {model_id}")
-        ai_result = ai_analyzer.analyze(page_images, model_id, exam_type, subjects)
-        ai_questions = ai_result["questions"]
-
-        if not ai_questions:
-            raise ValueError("AI did not detect any questions in the paper")
-
-        logger.info(f"[{job_id}] AI detected {len(ai_questions)} questions")
-
-        # Step 3: Subtopic Matching — always run with known exam_type
-        logger.info(f"[{job_id}] Step 3: Subtopic matching (exam_type={exam_type})")
-        ai_questions = subtopic_matcher.match_all(ai_questions, exam_type)
-
-        # Step 4: Generate outputs
-        logger.info(f"[{job_id}] Step 4: Generating DOCX/XLSX")
-        paper_name = os.path.splitext(pdf_file.filename)[0]
-        metadata = {
-            "paper_name": paper_name,
-            "exam_type": exam_type,
-            "subjects": subjects_str,
-            "model_used": model_id,
-        }
-
-        docx_filename = f"{paper_name}_Analysis_{job_id}.docx"
-        xlsx_filename = f"{paper_name}_Analysis_{job_id}.xlsx"
-        docx_path = os.path.join(OUTPUT_DIR, docx_filename)
-        xlsx_path = os.path.join(OUTPUT_DIR, xlsx_filename)
-
-        docx_generator.generate(ai_questions, metadata, docx_path)
-        xlsx_generator.generate(ai_questions, metadata, xlsx_path)
-
-        elapsed = time.time() - start_time
-        logger.info(f"[{job_id}] Done in {elapsed:.1f}s — {len(ai_questions)} questions")
-
+    pipeline_args = {
+        "pdf_path": pdf_path,
+        "paper_name": os.path.splitext(pdf_file.filename)[0],
+        "model_id": model_id,
+        "exam_type": exam_type,
+        "subjects": subjects,
+        "subjects_str": subjects_str,
+    }
+
+    if run_async:
+        save_job_status(job_id, {"status": "queued", "job_id": job_id, "upload_id": upload_id})
+        _job_executor.submit(run_job, job_id, upload_id, start_time, **pipeline_args)
+        logger.info(f"[{job_id}] Queued for background processing")
         return jsonify({
-            "status": "completed",
+            "status": "queued",
             "job_id": job_id,
             "upload_id": upload_id,
-            "questions_count": len(ai_questions),
-            "exam_type": exam_type,
-            "subjects": subjects_str,
-            "model_used": model_id,
-            "processing_time": round(elapsed, 1),
-            "docx_filename": docx_filename,
-            "xlsx_filename": xlsx_filename,
-            "docx_url": f"/download/{docx_filename}",
-            "xlsx_url": f"/download/{xlsx_filename}",
-            "questions": ai_questions,  # Full results for WP to store
-        })
+            "status_url": f"/status/{job_id}",
+        }), 202
 
+    try:
+        return jsonify(run_pipeline(job_id=job_id, upload_id=upload_id, start_time=start_time, **pipeline_args))
     except Exception as e:
-        elapsed = time.time() - start_time
-        logger.error(f"[{job_id}] Failed: {e}\n{traceback.format_exc()}")
-        return jsonify({
-            "status": "failed",
-            "error": str(e),
-            "processing_time": round(elapsed, 1),
-        }), 500
+        return jsonify(failure_result(job_id, e, start_time)), 500
+
+
+@app.route("/status/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Poll a queued /analyze job. Returns the full result once completed."""
+    path = os.path.join(JOBS_DIR, f"{job_id}.json")
+    if not os.path.exists(path):
+        return jsonify({"status": "not_found", "error": "Unknown job_id"}), 404
+    with open(path, "r", encoding="utf-8") as f:
+        return jsonify(json.load(f))
+
+
+def attachment_disposition(filename: str) -> str:
+    """
+    Content-Disposition for a download, built the way werkzeug's send_file does:
+    filenames come from uploads, so non-ASCII names get an ASCII fallback plus a
+    UTF-8 filename* (headers go out latin-1 encoded), and quotes are escaped.
+    """
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        value = {"filename": simple, "filename*": f"UTF-8''{quote(filename, safe='!#$&+^`|~')}"}
+    else:
+        value = {"filename": filename}
+    return dump_options_header("attachment", value)
 
 
 @app.route("/download/<filename>", methods=["GET"])
@@ -161,7 +364,22 @@ def download(filename):
     filepath = os.path.join(OUTPUT_DIR, filename)
     if not os.path.exists(filepath):
         return jsonify({"error": "File not found"}), 404
-    return send_file(filepath, as_attachment=True)
+
+    # Behind nginx, hand the transfer off to an internal location that aliases OUTPUT_DIR
+    if DOWNLOAD_ACCEL_PREFIX:
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        return Response(mimetype=mimetype, headers={
+            "X-Accel-Redirect": f"{DOWNLOAD_ACCEL_PREFIX.rstrip('/')}/{quote(filename)}",
+            "Content-Disposition": attachment_disposition(filename),
+            "Cache-Control": f"private, max-age={DOWNLOAD_MAX_AGE}",
+        })
+
+    # Conditional responses let clients revalidate with 304; the body goes out via wsgi.file_wrapper
+    response = send_file(filepath, as_attachment=True, conditional=True, max_age=DOWNLOAD_MAX_AGE)
+    # Reports belong to whoever uploaded the paper — keep them out of shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 
 @app.route("/models", methods=["GET"])
@@ -183,5 +401,6 @@ def reference_stats():
 
 
 if __name__ == "__main__":
+    # Local development only — production runs under gunicorn (see render.yaml)
     port = int(os.environ.get("PORT", 5050))
     app.run(host="0.0.0.0", port=port, debug=False)
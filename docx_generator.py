@@ -92,14 +92,16 @@ def analyze():
         ai_result = ai_analyzer.analyze(questions, model_id, exam_type, subject)
         ai_questions = ai_result["questions"]
 
-        # Merge diagram info
+        # Merge diagram info (first extracted question wins on duplicate numbers)
+        by_number = {}
+        for eq in questions:
+            by_number.setdefault(eq["number"], eq)
         for aq in ai_questions:
             sno = aq.get("sno", 0)
-            for eq in questions:
-                if eq["number"] == sno:
-                    aq["diagram_paths"] = eq.get("diagram_paths", [])
-                    aq["question_label"] = eq.get("label", f"Q.{sno}")
-                    break
+            eq = by_number.get(sno)
+            if eq is not None:
+                aq["diagram_paths"] = eq.get("diagram_paths", [])
+                aq["question_label"] = eq.get("label", f"Q.{sno}")
 
         # Step 3: Subtopic Matching
         logger.info(f"[{job_id}] Step 3: Subtopic matching")
@@ -0,0 +1,180 @@
+"""
+OpenRouter Client
+Shared HTTP plumbing for OpenRouter chat completions: pooled session with retries,
+SSE streaming, and tolerant JSON parsing of model replies.
+"""
+import os
+import logging
+import random
+import re
+import time
+import threading
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util import Retry
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+MAX_TIMEOUT_RETRIES = 2
+
+# Process-wide cap on in-flight completions. Each job already limits its own chunk
+# fan-out; this keeps concurrent jobs and sync requests together under the key's rate limit
+MAX_IN_FLIGHT = int(os.environ.get("OPENROUTER_MAX_IN_FLIGHT", "10"))
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+# Transient HTTP errors are retried by urllib3 with exponential backoff (honours Retry-After).
+# Which layer retries what:
+#   - failed connects (refused, DNS, connect timeout): urllib3, connect=2
+#   - 429/5xx responses: urllib3, status=3
+#   - read timeouts: call_openrouter's loop — the POST may already be generating a
+#     (billed) completion, so read=False raises them straight through
+#   - anything else (SSLError, protocol errors): not retried, other=0 fails fast
+#     instead of backing off forever under total=None
+_retry = Retry(
+    total=None,
+    connect=2,
+    read=False,
+    status=3,
+    other=0,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["POST"],
+    respect_retry_after_header=True,
+    raise_on_status=False,  # Hand the final error response back so we can report it
+)
+
+# Shared keep-alive session so chunks reuse pooled TLS connections to OpenRouter
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=_retry))
+_session.headers.update({
+    "Content-Type": "application/json",
+    "HTTP-Referer": "https://exam-analyzer.local",
+})
+
+# Optional ```json ... ``` wrapper around the model's JSON output
+_FENCE_RE = re.compile(r"\A\s*```(?:json)?(.*?)(?:```\s*)?\Z", re.DOTALL)
+
+
+def read_stream(response) -> str:
+    """
+    Accumulate the completion text from an OpenRouter SSE stream.
+    Comment lines (keep-alives) are skipped; errors sent mid-stream are raised.
+    A stall mid-stream is raised as requests.exceptions.ReadTimeout.
+    """
+    parts = []
+    try:
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            data = line[6:]
+            if data == b"[DONE]":
+                break
+
+            event = orjson.loads(data)
+            if "error" in event:
+                raise RuntimeError(f"OpenRouter stream error: {event['error']}")
+
+            choices = event.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                parts.append(delta)
+    except requests.exceptions.ConnectionError as e:
+        # requests wraps body read timeouts in ConnectionError; surface them as the
+        # Timeout they are so call_openrouter's retry loop handles them
+        if e.args and isinstance(e.args[0], ReadTimeoutError):
+            raise requests.exceptions.ReadTimeout(e.args[0], response=response) from e
+        raise
+
+    return "".join(parts)
+
+
+def call_openrouter(model_id: str, messages: list, max_tokens: int = 16000, timeout: int = 180) -> dict:
+    """
+    Send a chat completion to OpenRouter and return the full streamed text.
+    Returns {content, elapsed, model}.
+
+    Failed connects and 429/5xx are retried by the session's urllib3 Retry. Read
+    timeouts (no headers, or a stalled stream) are retried here, up to
+    MAX_TIMEOUT_RETRIES times with jittered backoff, then the ReadTimeout is re-raised.
+    """
+    api_key = os.environ.get("OPENROUTER_API_KEY", "")
+    if not api_key:
+        raise ValueError("OPENROUTER_API_KEY not set in environment")
+
+    headers = {"Authorization": f"Bearer {api_key}"}
+
+    payload = {
+        "model": model_id,
+        "messages": messages,
+        "temperature": 0.1,
+        "max_tokens": max_tokens,
+        "stream": True,  # Read the completion as it is generated instead of one buffered body
+    }
+    body = orjson.dumps(payload)  # Serialised once, reused by every timeout retry
+
+    for attempt in range(MAX_TIMEOUT_RETRIES + 1):
+        try:
+            # Timed from when the slot is acquired, so queueing doesn't skew chunk sizing
+            with _in_flight:
+                logger.info(f"Calling OpenRouter with model: {model_id} (attempt {attempt + 1})")
+                start = time.time()
+
+                with _session.post(
+                    OPENROUTER_URL,
+                    headers=headers,
+                    data=body,
+                    timeout=timeout,  # Applies per read while streaming
+                    stream=True,
+                ) as response:
+                    logger.info(f"OpenRouter responded in {time.time() - start:.1f}s — status {response.status_code}")
+
+                    if response.status_code != 200:
+                        error = response.text
+                        logger.error(f"OpenRouter error: {error}")
+                        raise RuntimeError(f"OpenRouter API error: {response.status_code} — {error}")
+
+                    content = read_stream(response)
+
+                elapsed = time.time() - start
+            logger.info(f"OpenRouter completion received in {elapsed:.1f}s ({len(content)} chars)")
+
+            return {"content": content, "elapsed": elapsed, "model": model_id}
+
+        except requests.exceptions.ReadTimeout:
+            # Connect timeouts are not caught here — urllib3 has already retried those
+            logger.warning(f"Read timeout calling {model_id} (attempt {attempt + 1} of {MAX_TIMEOUT_RETRIES + 1})")
+            if attempt == MAX_TIMEOUT_RETRIES:
+                raise
+            # Exponential backoff with jitter so parallel chunks don't retry in lockstep
+            time.sleep(min(30, 2 ** attempt) + random.random())
+
+
+def parse_json_response(raw_content: str) -> dict:
+    """Parse a model's JSON reply, handling common formatting issues (fences, stray prose)."""
+    # Strip markdown code fences if present (closing fence may be missing on truncated output).
+    # Surrounding whitespace is left in place — the JSON parser ignores it.
+    fenced = _FENCE_RE.match(raw_content)
+    content = fenced.group(1) if fenced else raw_content
+
+    try:
+        parsed = orjson.loads(content)
+    except orjson.JSONDecodeError as e:
+        logger.error(f"JSON parse error: {e}")
+        logger.error(f"Raw content (first 500 chars): {content[:500]}")
+        # Try to extract JSON object from the response
+        start = content.find("{")
+        end = content.rfind("}") + 1
+        if start >= 0 and end > start:
+            try:
+                parsed = orjson.loads(content[start:end])
+            except orjson.JSONDecodeError:
+                raise ValueError(f"Could not parse AI response as JSON: {e}")
+        else:
+            raise ValueError(f"No JSON object found in AI response: {e}")
+
+    return parsed
@@ -2,8 +2,11 @@
 DOCX Output Generator
 Creates landscape table with Unicode text + embedded diagram images in cells.
 """
+import io
 import os
 import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from docx import Document
@@ -11,6 +14,7 @@ from docx.shared import Inches, Pt, Cm, RGBColor
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.section import WD_ORIENT
+from docx.enum.style import WD_STYLE_TYPE
 from docx.oxml.ns import qn
 
 logger = logging.getLogger(__name__)
@@ -21,9 +25,18 @@ DIFFICULTY_COLORS = {
     "Difficult": {"bg": "FEE2E2", "fg": RGBColor(0x99, 0x1B, 0x1B)},
 }
 
+CELL_STYLE = "Table Cell"
+CELL_FONT_SIZE = 8
+
 HEADER_BG = "1E293B"
 SUBTOPIC_NO_BG = "EFF6FF"
 
+# Guard against runaway model output (e.g. repetition loops) bloating a single cell.
+# Well above any real question with its options, so normal text is never cut
+MAX_CELL_CHARS = 2000
+
+IMAGE_READ_WORKERS = 8
+
 COL_WIDTHS_CM = [1.2, 1.2, 9.0, 3.5, 3.5, 5.0, 1.8, 6.5, 2.0]
 HEADERS = [
     "S.No", "Q.No", "Question", "Chapter / Unit", "Topic",
@@ -31,6 +44,12 @@ HEADERS = [
 ]
 
 
+def clip_text(text, limit: int = MAX_CELL_CHARS) -> str:
+    # Model output isn't guaranteed to be a string (numbers, lists) — format it like set_cell_text
+    text = "" if text is None else str(text)
+    return text if len(text) <= limit else text[:limit].rstrip() + " […]"
+
+
 def set_cell_shading(cell, color_hex: str):
     shading = cell._element.get_or_add_tcPr()
     sd = shading.makeelement(qn("w:shd"), {
@@ -39,30 +58,72 @@ def set_cell_shading(cell, color_hex: str):
     shading.append(sd)
 
 
+def add_cell_style(doc):
+    """
+    Paragraph style shared by every table cell (Arial, CELL_FONT_SIZE, 2pt spacing),
+    so runs only carry the formatting that differs from it.
+    """
+    style = doc.styles.add_style(CELL_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+    style.font.name = "Arial"
+    style.font.size = Pt(CELL_FONT_SIZE)
+    style.paragraph_format.space_after = Pt(2)
+    style.paragraph_format.space_before = Pt(2)
+    return style
+
+
 def set_cell_text(cell, text: str, bold=False, italic=False, size=8.5,
-                  color=None, alignment=None):
+                  color=None, alignment=None, style=None):
     cell.text = ""
     p = cell.paragraphs[0]
     if alignment:
         p.alignment = alignment
     run = p.add_run(str(text))
-    run.font.name = "Arial"
-    run.font.size = Pt(size)
-    run.font.bold = bold
-    run.font.italic = italic
+    if style is not None:
+        # Write the pStyle id directly — Paragraph.style= re-resolves it against the styles part every call
+        p._p.style = style.style_id
+        if size != CELL_FONT_SIZE:
+            run.font.size = Pt(size)
+        if bold:
+            run.font.bold = True
+        if italic:
+            run.font.italic = True
+    else:
+        run.font.name = "Arial"
+        run.font.size = Pt(size)
+        run.font.bold = bold
+        run.font.italic = italic
+        p.paragraph_format.space_after = Pt(2)
+        p.paragraph_format.space_before = Pt(2)
     if color:
         run.font.color.rgb = color
-    p.paragraph_format.space_after = Pt(2)
-    p.paragraph_format.space_before = Pt(2)
 
 
-def add_image_to_cell(cell, image_path: str, max_width_cm=8.0):
-    if not os.path.exists(image_path):
+def read_image(image_path: str):
+    """Raw bytes of a diagram file, or None if it can't be read."""
+    try:
+        with open(image_path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def preload_images(questions: list) -> dict:
+    """Read every distinct diagram file up front, in parallel. Returns {path: bytes or None}."""
+    paths = list(dict.fromkeys(dp for q in questions for dp in q.get("diagram_paths") or []))
+    if not paths:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(paths), IMAGE_READ_WORKERS)) as ex:
+        return dict(zip(paths, ex.map(read_image, paths)))
+
+
+def add_image_to_cell(cell, image_path: str, max_width_cm=8.0, image_bytes: bytes = None):
+    if image_bytes is None and not os.path.exists(image_path):
         return
     try:
         p = cell.add_paragraph()
         run = p.add_run()
-        run.add_picture(image_path, width=Cm(max_width_cm))
+        source = io.BytesIO(image_bytes) if image_bytes is not None else image_path
+        run.add_picture(source, width=Cm(max_width_cm))
     except Exception as e:
         logger.warning(f"Failed to embed image {image_path}: {e}")
         p = cell.add_paragraph()
@@ -112,7 +173,11 @@ def generate(questions: list, metadata: dict, output_path: str) -> str:
     run.font.size = Pt(9)
     run.font.color.rgb = RGBColor(0x64, 0x74, 0x8B)
 
+    # Diagram files are read concurrently (and once each) before the row loop
+    images = preload_images(questions)
+
     # Table
+    cell_style = add_cell_style(doc)
     num_cols = len(HEADERS)
     table = doc.add_table(rows=1, cols=num_cols)
     table.alignment = WD_TABLE_ALIGNMENT.CENTER
@@ -129,7 +194,7 @@ def generate(questions: list, metadata: dict, output_path: str) -> str:
         cell = hdr.cells[i]
         set_cell_shading(cell, HEADER_BG)
         set_cell_text(cell, header_text, bold=True, size=8, color=RGBColor(0xFF, 0xFF, 0xFF),
-                      alignment=WD_ALIGN_PARAGRAPH.CENTER)
+                      alignment=WD_ALIGN_PARAGRAPH.CENTER, style=cell_style)
 
     # Data rows
     for idx, q in enumerate(questions):
@@ -138,50 +203,49 @@ def generate(questions: list, metadata: dict, output_path: str) -> str:
 
         sno = q.get("sno", idx + 1)
         qno = q.get("question_label", f"Q.{sno}")
-        question_text = q.get("question_text", "")
+        question_text = clip_text(q.get("question_text", ""))
         chapter = q.get("matched_unit_name") or q.get("topic", "")
         topic = q.get("topic", "")
         subtopic = q.get("matched_subtopic_name") or q.get("subtopic_name", "")
         sub_no = q.get("subtopic_number", "N/A")
-        concept = q.get("concept_tested", "")
+        concept = clip_text(q.get("concept_tested", ""))
         difficulty = q.get("difficulty", "Moderate")
 
         # S.No
-        set_cell_text(cells[0], str(sno), bold=True, alignment=WD_ALIGN_PARAGRAPH.CENTER)
+        set_cell_text(cells[0], str(sno), bold=True, alignment=WD_ALIGN_PARAGRAPH.CENTER, style=cell_style)
         # Q.No
-        set_cell_text(cells[1], qno, alignment=WD_ALIGN_PARAGRAPH.CENTER)
+        set_cell_text(cells[1], qno, alignment=WD_ALIGN_PARAGRAPH.CENTER, style=cell_style)
 
         # Question — text + optional image
-        set_cell_text(cells[2], question_text, size=8)
+        set_cell_text(cells[2], question_text, size=8, style=cell_style)
         diagram_paths = q.get("diagram_paths", [])
         if diagram_paths:
             for dp in diagram_paths:
-                add_image_to_cell(cells[2], dp, max_width_cm=7.5)
+                add_image_to_cell(cells[2], dp, max_width_cm=7.5, image_bytes=images.get(dp))
 
         # Chapter
-        set_cell_text(cells[3], chapter, size=8)
+        set_cell_text(cells[3], chapter, size=8, style=cell_style)
         # Topic
-        set_cell_text(cells[4], topic, size=8)
+        set_cell_text(cells[4], topic, size=8, style=cell_style)
         # Subtopic Name
-        set_cell_text(cells[5], subtopic, bold=True, size=8)
+        set_cell_text(cells[5], subtopic, bold=True, size=8, style=cell_style)
         # Subtopic Number
         set_cell_text(cells[6], sub_no, bold=True, size=9,
                       color=RGBColor(0x1D, 0x4E, 0xD8),
-                      alignment=WD_ALIGN_PARAGRAPH.CENTER)
+                      alignment=WD_ALIGN_PARAGRAPH.CENTER, style=cell_style)
         set_cell_shading(cells[6], SUBTOPIC_NO_BG)
         # Concept Tested
-        set_cell_text(cells[7], concept, italic=True, size=8)
+        set_cell_text(cells[7], concept, italic=True, size=8, style=cell_style)
         # Difficulty
         diff_cfg = DIFFICULTY_COLORS.get(difficulty, DIFFICULTY_COLORS["Moderate"])
         set_cell_text(cells[8], difficulty, bold=True, size=8,
-                      color=diff_cfg["fg"], alignment=WD_ALIGN_PARAGRAPH.CENTER)
+                      color=diff_cfg["fg"], alignment=WD_ALIGN_PARAGRAPH.CENTER, style=cell_style)
         set_cell_shading(cells[8], diff_cfg["bg"])
 
     # Summary
     doc.add_paragraph()
-    easy = sum(1 for q in questions if q.get("difficulty") == "Easy")
-    mod = sum(1 for q in questions if q.get("difficulty") == "Moderate")
-    diff = sum(1 for q in questions if q.get("difficulty") == "Difficult")
+    counts = Counter(q.get("difficulty") for q in questions)
+    easy, mod, diff = counts["Easy"], counts["Moderate"], counts["Difficult"]
 
     summary_p = doc.add_paragraph()
     run = summary_p.add_run(f"Summary: ")
@@ -3,43 +3,155 @@ PDF Extractor — Vision-based approach
 Converts PDF pages to images for AI vision models.
 Also extracts basic text for metadata detection (exam type, subject).
 """
+import io
 import os
 import base64
 import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import fitz  # PyMuPDF
+from PIL import Image
 
 logger = logging.getLogger(__name__)
 
 # Image settings
 PAGE_DPI = 200  # Good balance of quality vs size for math formulas
-MAX_PAGES = 30  # Safety limit
+# Upper bound on pages analysed per paper (chunking already bounds images per request).
+# Anything past it is reported back to the client as pages_total > pages_analyzed
+MAX_PAGES = int(os.environ.get("MAX_PDF_PAGES", "100"))
+MAX_IMAGE_SIDE = 1568  # Vision models downscale anything larger, so don't pay to send it
+WEBP_QUALITY = 85
+WEBP_METHOD = 1  # Encoder effort (0-6): ~3x faster than the default 4 for ~10% larger pages
+DATA_URL_PREFIX = "data:image/webp;base64,"
+
+# Metadata text only feeds substring checks: keep the mediabox clip but let MuPDF
+# expand ligatures and fold tabs/odd whitespace to plain spaces
+METADATA_TEXT_FLAGS = fitz.TEXT_MEDIABOX_CLIP
+
+# Lowercase keywords for detect_exam_type / detect_subject
+JEE_SIGNALS = ("jee main", "jee advanced", "jee mains", "iit jee", "jee (main)")
+NEET_SIGNALS = ("neet", "neet-ug", "neet ug", "national eligibility")
+BIOLOGY_SIGNALS = ("biology", "botany", "zoology")
+
+# Checked in priority order. "math" already covers maths / mathematics /
+# sr-mathematics, and likewise for the other sr- prefixes
+SUBJECT_SIGNALS = (
+    ("Mathematics", ("math",)),
+    ("Physics", ("physics",)),
+    ("Chemistry", ("chemistry",)),
+    ("Biology", BIOLOGY_SIGNALS),
+)
+
+# Rendering is CPU-bound and PyMuPDF holds the GIL, so longer papers render
+# page by page across separate processes
+RENDER_WORKERS = min(4, os.cpu_count() or 1)
+PARALLEL_RENDER_MIN_PAGES = 6
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn rather than fork — the gunicorn worker that calls this is multi-threaded
+            _render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _render_pool
+
+
+def _render_page(page, dpi: int) -> tuple:
+    """Render one page to a WebP data URL. Returns (data_url, width, height, bytes)."""
+    # Render page at specified DPI (72 is default PDF DPI), but never
+    # beyond the vision model's native resolution
+    zoom = min(dpi / 72, MAX_IMAGE_SIDE / max(page.rect.width, page.rect.height))
+    matrix = fitz.Matrix(zoom, zoom)
+    pix = page.get_pixmap(matrix=matrix, alpha=False)
+
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    buf = io.BytesIO()
+    img.save(buf, "WEBP", quality=WEBP_QUALITY, method=WEBP_METHOD)
+    img_bytes = buf.getvalue()
+
+    data_url = DATA_URL_PREFIX + base64.b64encode(img_bytes).decode("ascii")
+    return data_url, pix.width, pix.height, len(img_bytes)
+
+
+def _render_page_at(pdf_path: str, index: int, dpi: int) -> tuple:
+    """Render one page by index. Runs in a render pool process, so it opens its own document."""
+    with fitz.open(pdf_path) as doc:
+        return _render_page(doc[index], dpi)
+
+
+def _iter_page_images(doc, pdf_path: str, dpi: int):
+    """Yield page data URLs in page order as soon as each one is rendered."""
+    page_count = min(len(doc), MAX_PAGES)
+    if len(doc) > MAX_PAGES:
+        logger.warning(f"PDF has {len(doc)} pages, processing first {MAX_PAGES} only")
+
+    if RENDER_WORKERS > 1 and page_count >= PARALLEL_RENDER_MIN_PAGES:
+        # One task per page: workers take pages in order, so page 1 is ready after
+        # one page's render time rather than after a whole range
+        rendered = _get_render_pool().map(
+            _render_page_at, repeat(pdf_path), range(page_count), repeat(dpi), chunksize=1
+        )
+    else:
+        # Short papers render on the document that is already open
+        rendered = (_render_page(doc[i], dpi) for i in range(page_count))
+
+    for i, (data_url, width, height, size) in enumerate(rendered):
+        logger.info(f"Page {i+1}: rendered {width}x{height}px ({size//1024}KB)")
+        yield data_url
+
+
+def _pages_to_images(doc, pdf_path: str, dpi: int) -> list:
+    return list(_iter_page_images(doc, pdf_path, dpi))
+
+
+def _metadata_text(doc) -> str:
+    # Only need first 3 pages for metadata detection
+    return "".join(doc[i].get_text("text", flags=METADATA_TEXT_FLAGS) + "\n" for i in range(min(3, len(doc))))
 
 
 def pdf_pages_to_images(pdf_path: str, dpi: int = PAGE_DPI) -> list:
     """
-    Convert each PDF page to a PNG image, return as base64 strings.
+    Convert each PDF page to a WebP image, return as base64 data URLs
+    ready to drop into an image_url message part.
+    Pages are rendered at `dpi`, capped so the longest side is MAX_IMAGE_SIDE.
     """
-    doc = fitz.open(pdf_path)
-    page_images = []
+    with fitz.open(pdf_path) as doc:
+        return _pages_to_images(doc, pdf_path, dpi)
+
 
+def _stream_pages(doc, pdf_path: str, dpi: int) -> tuple:
+    """Return (page_count, pages) for an open document. pages owns doc and closes it when done."""
     page_count = min(len(doc), MAX_PAGES)
-    if len(doc) > MAX_PAGES:
-        logger.warning(f"PDF has {len(doc)} pages, processing first {MAX_PAGES} only")
+    if not page_count:
+        # Callers reject an empty PDF without iterating, so the generator's finally never runs
+        doc.close()
+        return 0, iter(())
+
+    def pages():
+        try:
+            yield from _iter_page_images(doc, pdf_path, dpi)
+        finally:
+            doc.close()
 
-    for i in range(page_count):
-        page = doc[i]
-        # Render page to image at specified DPI
-        zoom = dpi / 72  # 72 is default PDF DPI
-        matrix = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=matrix)
-        img_bytes = pix.tobytes("png")
-        b64 = base64.b64encode(img_bytes).decode("utf-8")
-        page_images.append(b64)
-        logger.info(f"Page {i+1}: rendered {pix.width}x{pix.height}px ({len(img_bytes)//1024}KB)")
+    return page_count, pages()
 
-    doc.close()
-    return page_images
+
+def iter_pdf_pages(pdf_path: str, dpi: int = PAGE_DPI) -> tuple:
+    """
+    Streaming form of pdf_pages_to_images. Returns (page_count, pages), where pages
+    yields each page's data URL as soon as it is rendered — the caller can start
+    sending early pages while later ones render. page_count is already capped at MAX_PAGES.
+    """
+    return _stream_pages(fitz.open(pdf_path), pdf_path, dpi)
 
 
 def extract_text_for_metadata(pdf_path: str) -> str:
@@ -47,24 +159,16 @@ def extract_text_for_metadata(pdf_path: str) -> str:
     Extract raw text from PDF — used ONLY for detecting exam type and subject.
     Not used for question analysis (vision handles that).
     """
-    doc = fitz.open(pdf_path)
-    text = ""
-    # Only need first 3 pages for metadata detection
-    for i in range(min(3, len(doc))):
-        text += doc[i].get_text() + "\n"
-    doc.close()
-    return text
+    with fitz.open(pdf_path) as doc:
+        return _metadata_text(doc)
 
 
 def detect_exam_type(text: str) -> str:
     """Detect JEE or NEET from paper content."""
     text_lower = text.lower()
 
-    jee_signals = ["jee main", "jee advanced", "jee mains", "iit jee", "jee (main)"]
-    neet_signals = ["neet", "neet-ug", "neet ug", "national eligibility"]
-
-    jee_score = sum(1 for s in jee_signals if s in text_lower)
-    neet_score = sum(1 for s in neet_signals if s in text_lower)
+    jee_score = sum(1 for s in JEE_SIGNALS if s in text_lower)
+    neet_score = sum(1 for s in NEET_SIGNALS if s in text_lower)
 
     if jee_score > neet_score:
         return "JEE"
@@ -72,7 +176,7 @@ def detect_exam_type(text: str) -> str:
         return "NEET"
 
     # Fallback: biology = NEET
-    if "biology" in text_lower or "botany" in text_lower or "zoology" in text_lower:
+    if any(w in text_lower for w in BIOLOGY_SIGNALS):
         return "NEET"
 
     return "UNKNOWN"
@@ -82,39 +186,43 @@ def detect_subject(text: str) -> str:
     """Detect subject from paper header text."""
     text_lower = text.lower()
 
-    if any(w in text_lower for w in ["mathematics", "maths", "math", "sr-mathematics"]):
-        return "Mathematics"
-    if any(w in text_lower for w in ["physics", "sr-physics"]):
-        return "Physics"
-    if any(w in text_lower for w in ["chemistry", "sr-chemistry"]):
-        return "Chemistry"
-    if any(w in text_lower for w in ["biology", "botany", "zoology", "sr-biology"]):
-        return "Biology"
+    for subject, signals in SUBJECT_SIGNALS:
+        if any(w in text_lower for w in signals):
+            return subject
 
     return "UNKNOWN"
 
 
-def process_pdf(pdf_path: str, temp_dir: str) -> dict:
+def process_pdf(pdf_path: str) -> dict:
     """
     Main entry point.
-    Converts PDF to page images + detects metadata.
-    Returns everything needed for AI vision analysis.
+    Detects metadata and streams page images for AI vision analysis.
+    page_images is a lazy iterator (see iter_pdf_pages): pages render as it is
+    consumed, so the caller must iterate it to release the document.
     """
     logger.info(f"Processing PDF: {pdf_path}")
 
-    # 1. Convert pages to images for AI vision
-    page_images = pdf_pages_to_images(pdf_path)
-    logger.info(f"Converted {len(page_images)} pages to images")
+    # One open document serves both passes (render pool workers still open their own)
+    doc = fitz.open(pdf_path)
+    try:
+        # 1. Extract text only for metadata detection
+        metadata_text = _metadata_text(doc)
+        pages_total = len(doc)
+    except Exception:
+        doc.close()
+        raise
+
+    # 2. Convert pages to images for AI vision, lazily
+    page_count, page_images = _stream_pages(doc, pdf_path, PAGE_DPI)
 
-    # 2. Extract text only for metadata detection
-    metadata_text = extract_text_for_metadata(pdf_path)
     exam_type = detect_exam_type(metadata_text)
     subject = detect_subject(metadata_text)
-    logger.info(f"Detected exam={exam_type}, subject={subject}")
+    logger.info(f"Detected exam={exam_type}, subject={subject}, streaming {page_count} pages")
 
     return {
         "pdf_path": pdf_path,
-        "page_count": len(page_images),
+        "page_count": page_count,
+        "pages_total": pages_total,
         "page_images": page_images,
         "exam_type": exam_type,
         "subject": subject,
@@ -3,15 +3,23 @@ Subtopic Matcher — Render version
 Loads reference data from JSON files (no MySQL).
 """
 import os
-import json
 import logging
-from rapidfuzz import fuzz
+
+import numpy as np
+import orjson
+from rapidfuzz import fuzz, process
 
 logger = logging.getLogger(__name__)
 
 FUZZY_MATCH_THRESHOLD = 60
+# Questions scoring below this against their own exam are re-tried against the other one.
+# The retry is one batched cdist per subject, so it is kept at the full threshold
+ALT_EXAM_TRIGGER = FUZZY_MATCH_THRESHOLD
 REF_DIR = os.path.join(os.path.dirname(__file__), "reference_data")
 _cache = {}
+_choices_cache = {}
+_exact_cache = {}
+_stats_cache = {}
 
 # Map frontend subject names to reference file names
 SUBJECT_MAP = {
@@ -24,6 +32,11 @@ SUBJECT_MAP = {
 }
 
 
+def sort_tokens(text: str) -> str:
+    """Lowercased, whitespace tokens sorted — the form token_sort_ratio compares internally."""
+    return " ".join(sorted(text.lower().split()))
+
+
 def load_reference(exam_type: str, subject: str) -> list:
     # Map subject name to reference file subject
     ref_subject = SUBJECT_MAP.get(subject, subject)
@@ -36,67 +49,148 @@ def load_reference(exam_type: str, subject: str) -> list:
 
     if not os.path.exists(filepath):
         logger.warning(f"No reference file: {filepath}")
+        # _cache is the "loaded" marker that other threads check, so it is written last
+        _choices_cache[key] = []
+        _exact_cache[key] = {}
         _cache[key] = []
         return []
 
-    with open(filepath, "r", encoding="utf-8") as f:
-        rows = json.load(f)
-
-    _cache[key] = rows
+    with open(filepath, "rb") as f:
+        rows = orjson.loads(f.read())
+
+    # Normalise the match texts once here rather than on every lookup. Choices are
+    # stored token-sorted, so scoring is a plain fuzz.ratio (same result as token_sort_ratio)
+    choices = []
+    for r in rows:
+        choices.append(sort_tokens(r["subtopic_name"]))
+        choices.append(sort_tokens(f"{r['unit_name']}: {r['subtopic_name']}"))
+
+    # Any choice a bare-subtopic query equals scores a perfect 100, and the first such
+    # choice is what the cdist scan would pick — so those questions can stop here
+    exact = {}
+    for i, text in enumerate(choices):
+        exact.setdefault(text, rows[i // 2])
+
+    _choices_cache[key] = choices
+    _exact_cache[key] = exact
+    _cache[key] = rows  # Last — see above
     logger.info(f"Loaded {len(rows)} reference subtopics for {exam_type}/{ref_subject}")
     return rows
 
 
-def match_subtopic(ai_subtopic: str, ai_topic: str, exam_type: str, subject: str) -> dict:
+def load_choices(exam_type: str, subject: str) -> list:
+    """
+    Lowercased, token-sorted match texts for each reference row, interleaved as
+    [subtopic, "unit: subtopic", ...] so choice index // 2 is the row index.
+    Built alongside the rows in load_reference.
+    """
+    load_reference(exam_type, subject)
+    return _choices_cache[f"{exam_type}_{SUBJECT_MAP.get(subject, subject)}"]
+
+
+NO_MATCH = {"subtopic_number": "N/A", "matched_name": None, "confidence": 0, "unit_name": None}
+
+
+def _match_result(row: dict, score: float) -> dict:
+    return {
+        "subtopic_number": row["subtopic_number"],
+        "matched_name": row["subtopic_name"],
+        "unit_name": row["unit_name"],
+        "confidence": score,
+    }
+
+
+def match_subtopic_batch(questions: list, exam_type: str, subject: str) -> list:
+    """
+    Match every question's AI subtopic/topic against one reference file.
+    Perfect subtopic hits (same tokens as a choice, any order or case) exit early via
+    dict lookup; the rest are scored in a single cdist call. Returns one result dict per question.
+    """
     refs = load_reference(exam_type, subject)
-    if not refs:
-        return {"subtopic_number": "N/A", "matched_name": None, "confidence": 0, "unit_name": None}
-
-    candidates = []
-    for r in refs:
-        candidates.append({"ref": r, "text": r["subtopic_name"]})
-        candidates.append({"ref": r, "text": f"{r['unit_name']}: {r['subtopic_name']}"})
-
-    queries = [ai_subtopic, f"{ai_topic}: {ai_subtopic}", f"{ai_topic} {ai_subtopic}"]
-    best_match, best_score = None, 0
-
-    for query in queries:
-        for cand in candidates:
-            score = fuzz.token_sort_ratio(query.lower(), cand["text"].lower())
-            if score > best_score:
-                best_score = score
-                best_match = cand["ref"]
-
-    if best_match:
-        return {
-            "subtopic_number": best_match["subtopic_number"],
-            "matched_name": best_match["subtopic_name"],
-            "unit_name": best_match["unit_name"],
-            "confidence": best_score,
-        }
-    return {"subtopic_number": "N/A", "matched_name": None, "confidence": 0, "unit_name": None}
+    if not refs or not questions:
+        return [dict(NO_MATCH) for _ in questions]
+
+    exact = _exact_cache[f"{exam_type}_{SUBJECT_MAP.get(subject, subject)}"]
+    results = [None] * len(questions)
+    pending = []
+    queries = []
+    for i, q in enumerate(questions):
+        ai_subtopic, ai_topic = q.get("subtopic_name", ""), q.get("topic", "")
+        subtopic_query = sort_tokens(ai_subtopic)
+        hit = exact.get(subtopic_query)
+        if hit is not None:
+            results[i] = _match_result(hit, 100.0)
+            continue
+        pending.append(i)
+        queries.append(subtopic_query)
+        queries.append(sort_tokens(f"{ai_topic}: {ai_subtopic}"))
+        queries.append(sort_tokens(f"{ai_topic} {ai_subtopic}"))
+
+    if not pending:
+        return results
+
+    # One row per question covering its 3 queries × all choices. argmax per row keeps
+    # the first best hit, same as scanning query by query.
+    choices = load_choices(exam_type, subject)
+    scores = process.cdist(queries, choices, scorer=fuzz.ratio, dtype=np.float64, workers=-1)
+    scores = scores.reshape(len(pending), -1)
+    best_cols = scores.argmax(axis=1) % len(choices)
+    best_scores = scores.max(axis=1)
+
+    for i, col, score in zip(pending, best_cols, best_scores):
+        results[i] = _match_result(refs[col // 2], float(score)) if score > 0 else dict(NO_MATCH)
+    return results
+
+
+def match_subtopic(ai_subtopic: str, ai_topic: str, exam_type: str, subject: str) -> dict:
+    question = {"subtopic_name": ai_subtopic, "topic": ai_topic}
+    return match_subtopic_batch([question], exam_type, subject)[0]
 
 
 def match_all(questions: list, exam_type: str) -> list:
+    by_subject = {}
     for q in questions:
-        subject = q.get("subject", "Mathematics")
-        result = match_subtopic(q.get("subtopic_name", ""), q.get("topic", ""), exam_type, subject)
+        by_subject.setdefault(q.get("subject", "Mathematics"), []).append(q)
+
+    alt = "NEET" if exam_type == "JEE" else "JEE"
+    for subject, group in by_subject.items():
+        results = match_subtopic_batch(group, exam_type, subject)
 
         # If low confidence, try the other exam type as fallback
-        if result["confidence"] < FUZZY_MATCH_THRESHOLD:
-            alt = "NEET" if exam_type == "JEE" else "JEE"
-            alt_result = match_subtopic(q.get("subtopic_name", ""), q.get("topic", ""), alt, subject)
-            if alt_result["confidence"] > result["confidence"]:
-                result = alt_result
-
-        q["subtopic_number"] = result["subtopic_number"]
-        q["match_confidence"] = result["confidence"]
-        q["matched_subtopic_name"] = result["matched_name"]
-        q["matched_unit_name"] = result["unit_name"]
+        low = [i for i, r in enumerate(results) if r["confidence"] < ALT_EXAM_TRIGGER]
+        if low:
+            alt_results = match_subtopic_batch([group[i] for i in low], alt, subject)
+            for i, alt_result in zip(low, alt_results):
+                if alt_result["confidence"] > results[i]["confidence"]:
+                    results[i] = alt_result
+
+        for q, result in zip(group, results):
+            q["subtopic_number"] = result["subtopic_number"]
+            q["match_confidence"] = result["confidence"]
+            q["matched_subtopic_name"] = result["matched_name"]
+            q["matched_unit_name"] = result["unit_name"]
     return questions
 
 
+def preload():
+    """
+    Load every reference file in REF_DIR into the caches up front. Called at app import,
+    so with gunicorn --preload the parsed references are shared by all forked workers.
+    """
+    if not os.path.exists(REF_DIR):
+        return
+    for f in os.listdir(REF_DIR):
+        if f.endswith(".json"):
+            parts = f.replace(".json", "").split("_", 1)
+            if len(parts) == 2:
+                load_reference(parts[0], parts[1])
+
+
 def get_stats() -> list:
+    """
+    Subtopic counts per reference file. /health calls this on every probe, so counts come
+    from already-loaded references or a per-(path, mtime) cache instead of re-parsing.
+    """
     stats = []
     if not os.path.exists(REF_DIR):
         return stats
@@ -104,12 +198,22 @@ def get_stats() -> list:
         if f.endswith(".json"):
             parts = f.replace(".json", "").split("_", 1)
             if len(parts) == 2:
-                filepath = os.path.join(REF_DIR, f)
-                with open(filepath, "r") as fh:
-                    data = json.load(fh)
-                stats.append({"exam_type": parts[0], "subject": parts[1], "count": len(data)})
+                key = f"{parts[0]}_{parts[1]}"
+                if key in _cache:
+                    count = len(_cache[key])
+                else:
+                    filepath = os.path.join(REF_DIR, f)
+                    stat_key = (filepath, os.stat(filepath).st_mtime)
+                    if stat_key not in _stats_cache:
+                        with open(filepath, "rb") as fh:
+                            _stats_cache[stat_key] = len(orjson.loads(fh.read()))
+                    count = _stats_cache[stat_key]
+                stats.append({"exam_type": parts[0], "subject": parts[1], "count": count})
     return stats
 
 
 def clear_cache():
     _cache.clear()
+    _choices_cache.clear()
+    _exact_cache.clear()
+    _stats_cache.clear()